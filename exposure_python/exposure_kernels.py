@@ -0,0 +1,79 @@
+""" Scalar kernels for the CCTV exposure hot paths, compiled with numba on request (see compile_kernels) """
+from math import asin, atan2, cos, degrees, log, pi, radians, sin, tan
+import numpy as np
+
+R = 6371
+CAM_ROUND, CAM_DIRECTED, CAM_DIRECTED_360 = 0, 1, 2  # cam_type_code values, -1 for unknown types
+
+
+def in_view_angle(bearing, direction, half_angle):
+    """ Check bearing against the view angle of a directed camera, wrap-safe across 0/360 degrees """
+    return np.abs((bearing - direction + 540.0) % 360.0 - 180.0) <= half_angle
+
+
+# Same rule for the scalar kernels, main uses in_view_angle on arrays
+_in_view_angle = in_view_angle
+
+
+def _quick_dist_sq(lat0, lon0, lat1, lon1):
+    """ Scalar version of main.quick_distance_sq """
+    x = lat1 - lat0
+    y = (lon1 - lon0) * cos((lat1 + lat0) * 0.00872664626)
+    return x * x + y * y
+
+
+def _get_bearing(lat0, lon0, lat1, lon1):
+    """ Scalar version of main.get_bearing """
+    dlon = radians(lon1) - radians(lon0)
+    dphi = log(tan(radians(lat1) / 2.0 + pi / 4.0) / tan(radians(lat0) / 2.0 + pi / 4.0))
+    if abs(dlon) > pi:
+        if dlon > 0.0:
+            dlon = -(2.0 * pi - dlon)
+        else:
+            dlon = (2.0 * pi + dlon)
+    return (degrees(atan2(dlon, dphi)) + 360.0) % 360.0
+
+
+def _test_points(lat, lon, course, points, resolution, cams, cam_lat, cam_lon, cam_fov_sq, cam_type, cam_dir,
+                 cam_half_angle):
+    """ Count the pseudo points along course that stay in camera fov, per camera in cams """
+    result = np.zeros(len(cams), dtype=np.int64)
+    lat1 = radians(lat)
+    lon1 = radians(lon)
+    brng = radians(course)
+    sin_lat1, cos_lat1 = sin(lat1), cos(lat1)
+    sin_brng, cos_brng = sin(brng), cos(brng)
+    for i in range(len(cams)):
+        cam = cams[i]
+        count = 0
+        for point in range(points):
+            d = resolution * (point + 1) / 1000 / R
+            sin_d, cos_d = sin(d), cos(d)
+            sin_lat2 = sin_lat1 * cos_d + cos_lat1 * sin_d * cos_brng
+            new_lat = degrees(asin(sin_lat2))
+            new_lon = degrees(lon1 + atan2(sin_brng * sin_d * cos_lat1, cos_d - sin_lat1 * sin_lat2))
+            if not _quick_dist_sq(new_lat, new_lon, cam_lat[cam], cam_lon[cam]) <= cam_fov_sq[cam]:
+                break
+            if cam_type[cam] == CAM_DIRECTED:
+                bearing = _get_bearing(cam_lat[cam], cam_lon[cam], new_lat, new_lon)
+                if not _in_view_angle(bearing, cam_dir[cam], cam_half_angle[cam]):
+                    break
+            count += 1
+        result[i] = count
+    return result
+
+
+def compile_kernels():
+    """ Compile the kernels with numba, once. Returns the compiled _test_points, None when numba is not installed.
+    numba is imported only here, its import and first call cost more than the kernel saves on short routes """
+    global _in_view_angle, _quick_dist_sq, _get_bearing, _test_points
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+    if not hasattr(_test_points, 'py_func'):
+        # Rebinding the globals lets the compiled _test_points call the compiled helpers
+        jit = njit(cache=True, fastmath=True)
+        _in_view_angle, _quick_dist_sq, _get_bearing, _test_points = (
+            jit(func) for func in (_in_view_angle, _quick_dist_sq, _get_bearing, _test_points))
+    return _test_points
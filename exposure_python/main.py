@@ -7,9 +7,10 @@ import gpxpy
 import gpxpy.gpx
 import numpy as np
 import random
+from itertools import compress, zip_longest
+from exposure_kernels import CAM_DIRECTED, CAM_DIRECTED_360, CAM_ROUND, R, compile_kernels, in_view_angle
 
 LOGGER = logging.getLogger()
-R = 6371
 resolution = 0.5    # pseudo point distance in meters
 
 
@@ -25,8 +26,9 @@ def haversine_distance(lat0, lon0, lat1, lon1):
     lon_diff_rad = np.deg2rad(lon1 - lon0)
     radlat = np.deg2rad(lat0)
     radlat1 = np.deg2rad(lat1)
-    a = np.power(np.sin(lat_diff_rad / 2.), 2.) + np.power(np.sin(lon_diff_rad / 2.), 2.) * np.cos(radlat) * np.cos(
-        radlat1)
+    sin_dlat = np.sin(lat_diff_rad / 2.)
+    sin_dlon = np.sin(lon_diff_rad / 2.)
+    a = sin_dlat * sin_dlat + sin_dlon * sin_dlon * np.cos(radlat) * np.cos(radlat1)
     c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     return R * c * 1000
 
@@ -37,14 +39,23 @@ def get_coordinates(lat, lng, bearing, distance):
     d = distance / 1000  # Distance m converted to km
     lat1 = np.deg2rad(lat)  # Current dd lat point converted to radians
     lon1 = np.deg2rad(lng)  # Current dd long point converted to radians
-    lat2 = np.arcsin(np.sin(lat1) * np.cos(d / R) + np.cos(lat1) * np.sin(d / R) * np.cos(brng))
-    lon2 = lon1 + np.arctan2(np.sin(brng) * np.sin(d / R) * np.cos(lat1), np.cos(d / R) - np.sin(lat1) * np.sin(lat2))
+    # Each term evaluated once, distance may be an array of many steps
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_d, cos_d = np.sin(d / R), np.cos(d / R)
+    sin_lat2 = sin_lat1 * cos_d + cos_lat1 * sin_d * np.cos(brng)
+    lat2 = np.arcsin(sin_lat2)
+    lon2 = lon1 + np.arctan2(np.sin(brng) * sin_d * cos_lat1, cos_d - sin_lat1 * sin_lat2)
     return [np.degrees(lat2), np.degrees(lon2)]
 
 
-def quick_distance(lat0, lon0, lat1, lon1):
-    """ Calculate distance between coordinates using Euclidean distance (quick and accurate enough for really short
-    distances """
+def mercator_lat(lat):
+    """ Mercator projected latitude, the per-coordinate term of get_bearing """
+    return np.log(np.tan(np.deg2rad(lat) / 2.0 + np.pi / 4.0))
+
+
+def quick_distance_sq(lat0, lon0, lat1, lon1):
+    """ Squared Euclidean distance between coordinates in degrees (quick and accurate enough for really short
+    distances). Compare against radii squared in the same units, i.e. meters / 111319 """
     x = lat1 - lat0
     y = (lon1 - lon0) * np.cos((lat1 + lat0) * 0.00872664626)
     """
@@ -52,18 +63,20 @@ def quick_distance(lat0, lon0, lat1, lon1):
     you could replace it with your median value like here https://www.cartographyunchained.com/cgsta1/ or
     replace it with a simple lookup table.
     """
-    return 111319 * np.sqrt(x * x + y * y)
+    return x * x + y * y
 
 
 def get_bearing(lat0, lon0, lat1, lon1):
     """ Get bearing between coordinates """
+    return mercator_bearing(mercator_lat(lat0), lon0, mercator_lat(lat1), lon1)
+
+
+def mercator_bearing(merc0, lon0, merc1, lon1):
+    """ Get bearing between coordinates whose latitudes are already projected with mercator_lat """
     dlon = np.deg2rad(lon1) - np.deg2rad(lon0)
-    dphi = np.log(np.tan(np.deg2rad(lat1) / 2.0 + np.pi / 4.0) / np.tan(np.deg2rad(lat0) / 2.0 + np.pi / 4.0))
-    if abs(dlon) > np.pi:
-        if dlon > 0.0:
-            dlon = -(2.0 * np.pi - dlon)
-        else:
-            dlon = (2.0 * np.pi + dlon)
+    dphi = merc1 - merc0
+    # Wrap longitude difference into [-pi, pi], works for scalars and arrays alike
+    dlon = np.where(np.abs(dlon) > np.pi, dlon - np.copysign(2.0 * np.pi, dlon), dlon)
     return (np.degrees(np.arctan2(dlon, dphi)) + 360.0) % 360.0
 
 
@@ -73,95 +86,110 @@ class CCTVExposure:
     def __init__(self, args, gpx):
         self.camfile = args.camfile
         self.radius = args.radius
+        # numba compiled pseudo point kernel, only on request (see compile_kernels)
+        self.test_points_kernel = compile_kernels() if args.numba else None
+        if args.numba and self.test_points_kernel is None:
+            LOGGER.warning('numba is not installed, using the NumPy pseudo points')
         self.accept_range = 1.0  # how many meters above radius meters, that we accept the "second in fov"
-        self.cams = self.load_cameras()
+        self.cam_columns, self.cam_rows = self.load_cameras()
         self.time_enabled = True
         self.points = gpx.points
-        self.distances = []
+        self.lats = np.fromiter((p.latitude for p in self.points), dtype=np.float64, count=len(self.points))
+        self.lons = np.fromiter((p.longitude for p in self.points), dtype=np.float64, count=len(self.points))
+        # POSIX seconds (NaN when missing), gpxpy times are timezone aware which np.datetime64 does not represent
+        self.times = np.fromiter((p.time.timestamp() if p.time else np.nan for p in self.points), dtype=np.float64,
+                                 count=len(self.points))
+        self.speeds = np.fromiter((p.speed or 0.0 for p in self.points), dtype=np.float64, count=len(self.points))
+        # Loop invariant per-point terms of quick_distance_sq and get_bearing, see point_in_camera_fov
+        self.sin_hplat, self.cos_hplat = np.sin(self.lats * 0.00872664626), np.cos(self.lats * 0.00872664626)
+        self.merc_plat = mercator_lat(self.lats)
         self.cameras_per_point = dict()
         self.unique_cameras = set()
         self.cam_amount = 0
-        self.cam_expo = {}
+        self.cam_expo_points = dict()  # camera index -> indices of the points it was accounted at
+        self.cam_expo_dist = np.zeros(len(self.cam_rows))
+        self.cam_expo_time = np.zeros(len(self.cam_rows))
         self.speed_enabled = False
+        self._compute_geometry()
         self.track_route()
         self.total_distance = self.get_total_distance()
         self.total_time = self.points[-1].time - self.points[0].time if self.time_enabled else 0
 
+    def _compute_geometry(self):
+        """ Compute all route geometry in one go: point-to-camera distances D[N, M] and FoV hits, and per-segment
+        (index i = point i to point i + 1) distance, course both ways and pseudo point count """
+        # Every point-to-camera distance goes into calc_distance_stats, so the full table is needed anyway and a
+        # spatial index over the cameras would not save any of the distance work
+        self.hits, self.D = self.point_in_camera_fov()
+        # Segments reuse the per-point terms of the camera table, expanded the same way as in point_in_camera_fov
+        cos_avg = self.cos_hplat[:-1] * self.cos_hplat[1:] - self.sin_hplat[:-1] * self.sin_hplat[1:]
+        x = self.lats[1:] - self.lats[:-1]
+        y = (self.lons[1:] - self.lons[:-1]) * cos_avg
+        self.seg_dist = 111319 * np.sqrt(x * x + y * y)
+        self.seg_course = mercator_bearing(self.merc_plat[:-1], self.lons[:-1], self.merc_plat[1:], self.lons[1:])
+        self.seg_course_back = mercator_bearing(self.merc_plat[1:], self.lons[1:], self.merc_plat[:-1], self.lons[:-1])
+        self.seg_points = np.where(self.seg_dist > resolution, np.rint(self.seg_dist / resolution), 1).astype(int)
+
     def get_total_distance(self):
         """ Calculate total distance """
-        distance = 0
-        number_of_points = len(self.points)
-        for i in range(number_of_points - 1):
-            distance += quick_distance(self.points[-1 - i].latitude, self.points[-1 - i].longitude,
-                                       self.points[-2 - i].latitude, self.points[-2 - i].longitude)
-        return distance
+        return self.seg_dist.sum()
 
     def track_route(self):
-        """ Go through route (single segment gpx) """
-        for index, point in enumerate(self.points):
-            if not point.time:
-                self.time_enabled = False
-            predictions, distances = self.point_in_camera_fov(point.latitude, point.longitude)
-            if point.speed:
-                self.speed_enabled = True
-
-            self.distances.extend(distances)
-            if predictions:
-                self.cameras_per_point.update({index: predictions})
-                self.unique_cameras.update(predictions)
+        """ Go through route (single segment gpx), collecting the cameras (index arrays) seen from each point """
+        self.time_enabled = not np.isnan(self.times).any()
+        self.speed_enabled = bool(self.speeds.any())
+
+        point_inds, cam_inds = np.nonzero(self.hits)
+        indices, starts = np.unique(point_inds, return_index=True)
+        self.cameras_per_point = dict(zip(indices.tolist(), np.split(cam_inds, starts[1:])))
+        self.unique_cameras.update(cam_inds.tolist())
 
         self.cam_amount = len(self.unique_cameras)
 
-    def point_in_camera_fov(self, lat, lon):
-        """ Check if a point is in camera area"""
-        results = dict()
-        distances = []
-        for cam in self.cams.items():
-            distance = quick_distance(lat, lon, float(cam[1].get('latitude')), float(cam[1].get('longitude')))
-            distances.append(distance)
-            if self.check_dist_to_cam(distance, cam[1], lat, lon):
-                results.update({cam[0]: cam[1]})
-        return results, distances
-
-    def check_dist_to_cam(self, d, cam, lat, lon, addon=0.0):
-        """ Check distance against camera FoV """
-        fov = self.radius if self.radius else float(cam.get('radius', 10))
-        if d <= fov + addon:
-            camtype = cam.get('camera type', 'round')
-            if camtype == 'round':
-                return True
-            elif camtype == 'directed':
-                angle = int(cam.get('angle of view', '360'))
-                direction = cam.get('direction', None)
-                if angle < 360:
-                    fov_range = ((direction - angle / 2 + 360.0) % 360.0, (direction + angle / 2 + 360.0) % 360.0)
-                    bearing = get_bearing(float(cam.get('latitude')), float(cam.get('longitude')), lat, lon)
-                    if fov_range[0] <= bearing <= fov_range[1]:
-                        return True
-                else:  # 360-degree directed
-                    return True
-        return False
+    def point_in_camera_fov(self):
+        """ Check if route points are in camera area, all points against all cameras at once. Returns (N, M)
+        shaped hits and distances """
+        # quick_distance_sq scaled to meters, with cos((lat + cam_lat) / 2) expanded so that only per-point and
+        # per-camera terms need trig
+        cos_avg = np.outer(self.cos_hplat, self.cos_hclat) - np.outer(self.sin_hplat, self.sin_hclat)
+        x = self.cam_lat - self.lats[:, None]
+        y = (self.cam_lon - self.lons[:, None]) * cos_avg
+        distances = 111319 * np.sqrt(x * x + y * y)
+        hit = distances <= self.cam_radius
+        # Bearings only for the directed cameras within range, usually a tiny part of the table
+        pts, cams = np.nonzero(hit & (self.cam_type_code == CAM_DIRECTED))
+        bearing = mercator_bearing(self.merc_clat[cams], self.cam_lon[cams], self.merc_plat[pts], self.lons[pts])
+        hit[pts, cams] = in_view_angle(bearing, self.cam_dir[cams], self.cam_half_angle[cams])
+        return hit, distances
+
+    def check_dist_to_cam(self, d_sq, cam, lat, lon):
+        """ Check squared distance (see quick_distance_sq) against FoV of camera index cam, accept range included.
+        d_sq, lat and lon are arrays of points """
+        in_fov = d_sq <= self.fov_sq_normalized[cam]
+        if self.cam_type_code[cam] == CAM_DIRECTED:
+            # Bearings only for the points within range
+            bearing = get_bearing(self.cam_lat[cam], self.cam_lon[cam], lat[in_fov], lon[in_fov])
+            in_fov[in_fov] = in_view_angle(bearing, self.cam_dir[cam], self.cam_half_angle[cam])
+        return in_fov
 
     def avg_speed_per_point(self, dist, point1, point2):
-        """ Calculate average speed per point """
-        return dist / np.absolute((self.points[point2].time - self.points[point1].time).total_seconds())
-
-    def test_points(self, ind, points, cam, course):
-        """ Test time in camera fov per second """
-        result = 0
-        lat = self.points[ind].latitude
-        lon = self.points[ind].longitude
-        for point in range(points):
-            new_lat, new_lon = get_coordinates(lat, lon, course, resolution)
-            cam_distance = quick_distance(new_lat, new_lon, float(self.cams[cam].get('latitude')),
-                                          float(self.cams[cam].get('longitude')))
-
-            if self.check_dist_to_cam(cam_distance, self.cams[cam], new_lat, new_lon, addon=self.accept_range):
-                result += 1
-            else:
-                break
-            lat = new_lat
-            lon = new_lon
+        """ Calculate average speed per point, 0 for repeated timestamps (e.g. paused GPS loggers) """
+        elapsed = abs(self.times[point2] - self.times[point1])
+        return dist / elapsed if elapsed else 0.0
+
+    def test_points(self, ind, points, cams, course):
+        """ Count the pseudo points along course that stay in camera fov, per camera in cams """
+        if self.test_points_kernel is not None:
+            return self.test_points_kernel(self.lats[ind], self.lons[ind], course, points, resolution, cams,
+                                           self.cam_lat, self.cam_lon, self.fov_sq_normalized, self.cam_type_code,
+                                           self.cam_dir, self.cam_half_angle)
+        steps = resolution * np.arange(1, points + 1)
+        new_lat, new_lon = get_coordinates(self.lats[ind], self.lons[ind], course, steps)
+        result = np.empty(len(cams), dtype=np.int64)
+        for i, cam in enumerate(cams):
+            cam_distance_sq = quick_distance_sq(new_lat, new_lon, self.cam_lat[cam], self.cam_lon[cam])
+            in_fov = self.check_dist_to_cam(cam_distance_sq, cam, new_lat, new_lon)
+            result[i] = points if in_fov.all() else np.argmin(in_fov)
         return result
 
     def calculate_direction(self, backward):
@@ -178,49 +206,50 @@ class CCTVExposure:
                     other_point = point_ind + 1
                 else:
                     continue
-            highest_dist = 0.0
-            highest_time = 0.0
-            course = get_bearing(self.points[point_ind].latitude, self.points[point_ind].longitude,
-                                 self.points[other_point].latitude, self.points[other_point].longitude)
-            distance = quick_distance(self.points[point_ind].latitude, self.points[point_ind].longitude,
-                                      self.points[other_point].latitude,
-                                      self.points[other_point].longitude)
-            points = int(np.rint(distance / resolution)) if distance > resolution else 1
-
-            for cam in cameras.keys():
-                if cam not in self.cam_expo.keys():
-                    self.cam_expo.update({cam: {'points': [], 'dist': 0.0, 'time': 0.0}})
-                if not backward and point_ind + 1 in self.cam_expo[cam]['points']:
+            segment = min(point_ind, other_point)
+            distance = self.seg_dist[segment]
+            points = int(self.seg_points[segment])
+            course = self.seg_course_back[segment] if backward else self.seg_course[segment]
+
+            seen, to_test = [], []
+            for cam in cameras.tolist():
+                exposed = self.cam_expo_points.setdefault(cam, set())
+                if not backward and point_ind + 1 in exposed:
                     continue
                 else:
-                    if point_ind not in self.cam_expo[cam]['points']:
-                        self.cam_expo[cam]['points'].append(point_ind)
-                    if backward and self.cameras_per_point.get(point_ind - 1) and \
-                            cam in self.cameras_per_point[point_ind - 1]:
-                        pseudo_points = points
-                    else:
-                        pseudo_points = self.test_points(point_ind, points, cam, course)
-
-                    speed = 0
-                    if self.speed_enabled:
-                        speed = self.points[point_ind].speed
-                    elif self.time_enabled:
-                        speed = self.avg_speed_per_point(distance, point_ind, other_point)
-                    if speed != 0:
-                        cam_time = (pseudo_points / (1 / resolution)) / speed
+                    exposed.add(point_ind)
+                    if backward and self.hits[point_ind - 1, cam]:
+                        seen.append(cam)
                     else:
-                        cam_time = np.abs(self.points[other_point].time.timestamp() - self.points[point_ind].time.timestamp())
-                    if cam_time > highest_time:
-                        highest_time = cam_time
-                    self.cam_expo[cam]['time'] += round(cam_time, 2)
-
-                    cam_dist = float(pseudo_points / (1 / resolution))
-                    if cam_dist > highest_dist:
-                        highest_dist = cam_dist
-                    self.cam_expo[cam]['dist'] += cam_dist
+                        to_test.append(cam)
+            if not seen and not to_test:
+                continue
+            cams = np.array(seen + to_test, dtype=np.int64)
+            pseudo_points = np.full(len(cams), points, dtype=np.int64)
+            if to_test:
+                # One test_points call per waypoint covers all of its cameras
+                pseudo_points[len(seen):] = self.test_points(point_ind, points, cams[len(seen):], course)
+
+            speed = 0
+            if self.speed_enabled:
+                speed = self.speeds[point_ind]
+            elif self.time_enabled:
+                speed = self.avg_speed_per_point(distance, point_ind, other_point)
+
+            cam_dist = pseudo_points * resolution
+            if speed != 0:
+                cam_time = cam_dist / speed
+            elif self.time_enabled:
+                cam_time = np.full(len(cams), abs(self.times[other_point] - self.times[point_ind]))
+            else:
+                # Neither speeds nor times in the track, no time to account (times are NaN then)
+                cam_time = np.zeros(len(cams))
+            # Cameras are unique within a point, so fancy indexed += accumulates every one of them
+            self.cam_expo_dist[cams] += cam_dist
+            self.cam_expo_time[cams] += cam_time
 
-            total_seconds += highest_time
-            total_meters += highest_dist
+            total_seconds += cam_time.max()
+            total_meters += cam_dist.max()
 
         return total_meters, total_seconds
 
@@ -232,27 +261,62 @@ class CCTVExposure:
 
     def calc_distance_stats(self):
         """ Calculate statistics on waypoint distances on cameras"""
-        avg = np.average(self.distances) if self.distances else 0
-        median = np.median(self.distances) if self.distances else 0
+        avg = np.average(self.D) if self.D.size else 0
+        median = np.median(self.D) if self.D.size else 0
         return avg, median
 
     def load_cameras(self):
-        """ Load camerafile """
+        """ Load camerafile into per-camera arrays (index = camera id), parsed a column at a time. The raw rows are
+        kept, dicts for the JSON output are built only for the cameras that end up in it (see camera_record) """
         try:
             with open(self.camfile, 'r') as camfile:
                 reader = csv.reader(camfile)
                 columns = next(reader)
-                cams = dict()
-                for index, row in enumerate(reader):
-                    cams[index] = dict()
-                    for i, column in enumerate(row):
-                        if column:
-                            cams.get(index, {}).update({columns[i]: column})
-                return cams
+                rows = list(reader)
         except (PermissionError, FileNotFoundError) as exc:
             LOGGER.error(str(exc))
             raise
 
+        cells = dict(zip(columns, zip_longest(*rows, fillvalue='')))
+        missing = ('',) * len(rows)
+
+        def column(name, default, dtype=np.float64, where=None):
+            """ Typed array of a camera file column, empty cells get default. With the boolean mask where, only the
+            selected rows are converted """
+            selected = cells.get(name, missing) if where is None else compress(cells.get(name, missing), where)
+            return np.array([cell or default for cell in selected], dtype=dtype)
+
+        camtypes = column('camera type', 'round', dtype=str)
+        directed = camtypes == 'directed'
+        # Angle matters only for directed cameras, other types may leave anything in the cell
+        angles = np.full(len(rows), 360)
+        angles[directed] = column('angle of view', '360', dtype=np.int32, where=directed)
+        self.cam_type_code = np.full(len(rows), -1, dtype=np.int8)
+        self.cam_type_code[camtypes == 'round'] = CAM_ROUND
+        self.cam_type_code[directed] = np.where(angles[directed] < 360, CAM_DIRECTED, CAM_DIRECTED_360)
+
+        self.cam_lat = column('latitude', 'nan')
+        self.cam_lon = column('longitude', 'nan')
+        self.cam_radius = np.full(len(rows), float(self.radius)) if self.radius else column('radius', '10')
+        # Loop invariant per-camera terms of quick_distance_sq and get_bearing, see point_in_camera_fov
+        self.sin_hclat, self.cos_hclat = np.sin(self.cam_lat * 0.00872664626), np.cos(self.cam_lat * 0.00872664626)
+        self.merc_clat = mercator_lat(self.cam_lat)
+        # Likewise direction, only read for directed cameras under 360 degrees
+        limited = self.cam_type_code == CAM_DIRECTED
+        self.cam_dir = np.zeros(len(rows))
+        self.cam_dir[limited] = column('direction', '0', where=limited)
+        # Kept as float, odd view angles have half-degree halves
+        self.cam_half_angle = angles / 2
+        # Unknown camera types are never in FoV
+        self.cam_radius[self.cam_type_code < 0] = np.nan
+        # FoV radii with the accept range, squared in quick_distance_sq units
+        self.fov_sq_normalized = ((self.cam_radius + self.accept_range) / 111319) ** 2
+        return columns, rows
+
+    def camera_record(self, cam):
+        """ Camera file row of camera index cam as a dict, empty cells left out """
+        return {column: cell for column, cell in zip(self.cam_columns, self.cam_rows[cam]) if cell}
+
 
 def main(args):
     """ CCTV Exposure main function """
@@ -292,10 +356,12 @@ def main(args):
                                'exposure_time': time})
             if exposure.radius:
                 result.update({'fov_radius': exposure.radius})
+            cam_times = np.round(exposure.cam_expo_time, 2)
             for cam in exposure.unique_cameras:
-                exposure.cams[cam].update({'time_in_camera_fov': exposure.cam_expo[cam].get('time'),
-                                           'distance_in_camera_fov': exposure.cam_expo[cam].get('dist')})
-                result['cameras'].update({cam: exposure.cams[cam]})
+                record = exposure.camera_record(cam)
+                record.update({'time_in_camera_fov': float(cam_times[cam]),
+                               'distance_in_camera_fov': float(exposure.cam_expo_dist[cam])})
+                result['cameras'].update({cam: record})
 
             print(json.dumps(result, indent=4))
 
@@ -308,4 +374,6 @@ if __name__ == '__main__':
                         default='/home/fusier/Documents/cctv/test/real1.gpx')
     parser.add_argument('-r', '--radius', required=False, type=int,
                         help='Field-of-view for cameras, overrides individual camera settings')
+    parser.add_argument('-n', '--numba', action='store_true',
+                        help='Compile the pseudo point kernels with numba, pays off on long routes only')
     main(parser.parse_args())
@@ -0,0 +1,106 @@
+""" Tests for the CCTV exposure calculations """
+import argparse
+import importlib.util
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import gpxpy.gpx
+import numpy as np
+
+from main import CCTVExposure
+
+
+def make_segment(duplicate=None, timed=True):
+    """ Route heading north in 5 m / 1 s steps, the point at index duplicate repeated (a paused logger). Without
+    timed the points have no times """
+    segment = gpxpy.gpx.GPXTrackSegment()
+    start = datetime(2022, 1, 28, 11, 45, tzinfo=timezone.utc)
+    for i in range(30):
+        time = start + timedelta(seconds=i) if timed else None
+        point = gpxpy.gpx.GPXTrackPoint(62.24 + i * 5 / 111319, 25.75, time=time)
+        segment.points.append(point)
+        if i == duplicate:
+            segment.points.append(gpxpy.gpx.GPXTrackPoint(point.latitude, point.longitude, time=point.time))
+    return segment
+
+
+class TestExposure(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.camfile = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        # Round camera 1 m east of the route, 75 m from its start
+        self.write_cameras(f'{62.24 + 75 / 111319},25.7501,round,10,,')
+
+    def tearDown(self):
+        os.remove(self.camfile)
+
+    def write_cameras(self, *rows):
+        """ Replace the camera file with rows of latitude,longitude,camera type,radius,angle of view,direction """
+        with open(self.camfile, 'w') as camfile:
+            camfile.write('latitude,longitude,camera type,radius,angle of view,direction\n')
+            camfile.writelines(f'{row}\n' for row in rows)
+
+    def exposure(self, segment, numba=False):
+        args = argparse.Namespace(camfile=self.camfile, radius=None, numba=numba)
+        exposure = CCTVExposure(args, segment)
+        return exposure, exposure.time_and_distance_in_camera_fov()
+
+    def test_duplicated_trackpoint(self):
+        """ A repeated position and timestamp adds no exposure time and does not turn any of it into NaN """
+        _, (dist, seconds) = self.exposure(make_segment())
+        exposure, (dup_dist, dup_seconds) = self.exposure(make_segment(duplicate=15))
+        self.assertTrue(np.isfinite(dup_seconds))
+        self.assertTrue(np.isfinite(dup_dist))
+        self.assertTrue(np.isfinite(exposure.cam_expo_time).all())
+        self.assertAlmostEqual(dup_seconds, seconds)
+        self.assertGreater(dup_seconds, 0)
+
+    def test_no_times(self):
+        """ A track without times or speeds still gets exposure distances, and zero (not NaN) camera times """
+        exposure, (dist, seconds) = self.exposure(make_segment(timed=False))
+        self.assertFalse(exposure.time_enabled)
+        self.assertGreater(dist, 0)
+        self.assertEqual(seconds, 0)
+        self.assertGreater(exposure.cam_expo_dist[0], 0)
+        self.assertEqual(exposure.cam_expo_time[0], 0)
+
+    def test_overlapping_cameras(self):
+        """ Every camera seen from a point accumulates its own exposure, the route counts only the highest """
+        camera = f'{62.24 + 75 / 111319},25.7501,round,10,,'
+        _, (dist, seconds) = self.exposure(make_segment())
+        self.write_cameras(camera, camera)
+        exposure, (both_dist, both_seconds) = self.exposure(make_segment())
+        self.assertGreater(exposure.cam_expo_dist[0], 0)
+        np.testing.assert_allclose(exposure.cam_expo_dist, exposure.cam_expo_dist[0])
+        np.testing.assert_allclose(exposure.cam_expo_time, exposure.cam_expo_time[0])
+        self.assertAlmostEqual(both_dist, dist)
+        self.assertAlmostEqual(both_seconds, seconds)
+
+    def test_directed_across_north(self):
+        """ A directed camera whose view spans north sees the route ahead of it, one facing away sees nothing """
+        lat, lon = 62.24 + 60 / 111319, 25.75 + 1 / 111319 / np.cos(np.deg2rad(62.24))
+        # Facing 10 degrees with a 60 degree view, i.e. from 340 to 40 degrees
+        self.write_cameras(f'{lat},{lon},directed,10,60,10', f'{lat},{lon},directed,10,60,100')
+        exposure, (dist, _) = self.exposure(make_segment())
+        self.assertGreater(exposure.cam_expo_dist[0], 0)
+        self.assertEqual(exposure.cam_expo_dist[1], 0)
+        self.assertEqual(exposure.cam_expo_time[1], 0)
+        self.assertAlmostEqual(dist, exposure.cam_expo_dist[0])
+
+    @unittest.skipUnless(importlib.util.find_spec('numba'), 'numba is not installed')
+    def test_numba_kernel(self):
+        """ The numba kernel counts the same pseudo points as the NumPy version """
+        lat, lon = 62.24 + 60 / 111319, 25.75 + 1 / 111319 / np.cos(np.deg2rad(62.24))
+        self.write_cameras(f'{62.24 + 75 / 111319},25.7501,round,10,,', f'{lat},{lon},directed,10,60,10')
+        exposure, totals = self.exposure(make_segment())
+        compiled, compiled_totals = self.exposure(make_segment(), numba=True)
+        self.assertIsNotNone(compiled.test_points_kernel)
+        np.testing.assert_allclose(compiled_totals, totals)
+        np.testing.assert_allclose(compiled.cam_expo_dist, exposure.cam_expo_dist)
+
+
+if __name__ == '__main__':
+    unittest.main()